@@ -0,0 +1,110 @@
+"""
+    The BlockMeter Experiment
+    ~~~~~~~~~
+    This module checks the block parser of sync-meters.py without a running
+    network. It builds a block with the Fabric protobufs, decodes it with the
+    SDK block decoder (the same one used by query_block) and verifies which
+    meters are extracted from it. The block carries a valid registerMeter
+    transaction, an invalid one (marked in the transactions filter) and a
+    config envelope. Only the valid registerMeter write must be returned.
+
+    :copyright: © 2020 by Wilson Melo Jr.
+"""
+
+import json
+import importlib.util
+from hfc.fabric.block_decoder import BlockDecoder
+from hfc.protos.common import common_pb2, configtx_pb2
+from hfc.protos.peer import chaincode_pb2, proposal_pb2, proposal_response_pb2, transaction_pb2
+from hfc.protos.ledger.rwset import rwset_pb2
+from hfc.protos.ledger.rwset.kvrwset import kv_rwset_pb2
+
+#Fabric validation code of a transaction that lost an MVCC read conflict
+MVCC_READ_CONFLICT = 11
+
+
+def load_sync_meters():
+    """Loads sync-meters.py as a module (its name is not a valid identifier)."""
+    spec = importlib.util.spec_from_file_location("sync_meters", "sync-meters.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_envelope(header_type, data):
+    """Wraps the payload data in an envelope with the given header type."""
+    channel_header = common_pb2.ChannelHeader(type=header_type, channel_id='ptb-channel')
+    header = common_pb2.Header(channel_header=channel_header.SerializeToString())
+    payload = common_pb2.Payload(header=header, data=data)
+    return common_pb2.Envelope(payload=payload.SerializeToString()).SerializeToString()
+
+
+def make_invoke_envelope(fcn, meter_id, pub_key):
+    """Builds an endorser transaction invoking fabpki and writing one meter."""
+    #the chaincode invocation, as sent in the proposal
+    cc_input = chaincode_pb2.ChaincodeInput(args=[fcn.encode(), meter_id.encode(), pub_key.encode()])
+    cc_spec = chaincode_pb2.ChaincodeSpec(
+        type=chaincode_pb2.ChaincodeSpec.GOLANG,
+        chaincode_id=chaincode_pb2.ChaincodeID(name='fabpki'),
+        input=cc_input)
+    invocation = chaincode_pb2.ChaincodeInvocationSpec(chaincode_spec=cc_spec)
+    proposal_payload = proposal_pb2.ChaincodeProposalPayload(input=invocation.SerializeToString())
+
+    #the write set produced by the chaincode PutState
+    value = json.dumps({"pubkey": pub_key}).encode()
+    kv_rwset = kv_rwset_pb2.KVRWSet(writes=[kv_rwset_pb2.KVWrite(key=meter_id, value=value)])
+    ns_rwset = rwset_pb2.NsReadWriteSet(namespace='fabpki', rwset=kv_rwset.SerializeToString())
+    tx_rwset = rwset_pb2.TxReadWriteSet(data_model=rwset_pb2.TxReadWriteSet.KV, ns_rwset=[ns_rwset])
+    cc_action = proposal_pb2.ChaincodeAction(results=tx_rwset.SerializeToString())
+    response_payload = proposal_response_pb2.ProposalResponsePayload(
+        extension=cc_action.SerializeToString())
+
+    #the endorsed action and the transaction that carries it
+    endorsed = transaction_pb2.ChaincodeEndorsedAction(
+        proposal_response_payload=response_payload.SerializeToString())
+    action_payload = transaction_pb2.ChaincodeActionPayload(
+        chaincode_proposal_payload=proposal_payload.SerializeToString(), action=endorsed)
+    tx = transaction_pb2.Transaction(actions=[
+        transaction_pb2.TransactionAction(payload=action_payload.SerializeToString())])
+
+    return make_envelope(common_pb2.ENDORSER_TRANSACTION, tx.SerializeToString())
+
+
+def make_block(envelopes, tx_filter):
+    """Builds a serialized block with the given envelopes and validation codes."""
+    block = common_pb2.Block()
+    block.header.number = 1
+    block.data.data.extend(envelopes)
+    #metadata entries: signatures, last config and transactions filter
+    block.metadata.metadata.extend([
+        common_pb2.Metadata().SerializeToString(),
+        common_pb2.Metadata(value=common_pb2.LastConfig(index=0).SerializeToString()).SerializeToString(),
+        bytes(tx_filter)])
+    return block.SerializeToString()
+
+
+if __name__ == "__main__":
+
+    #load the module under test
+    sync_meters = load_sync_meters()
+
+    #a valid registerMeter, an invalid one and a config envelope
+    envelopes = [
+        make_invoke_envelope('registerMeter', '100', 'valid public key'),
+        make_invoke_envelope('registerMeter', '200', 'invalid public key'),
+        make_envelope(common_pb2.CONFIG, configtx_pb2.ConfigEnvelope().SerializeToString()),
+    ]
+    block_bytes = make_block(envelopes, [0, MVCC_READ_CONFLICT, 0])
+
+    #decode the block exactly as query_block(decode=True) does
+    block = BlockDecoder.decode(block_bytes)
+    writes = sync_meters.get_meter_writes(block)
+
+    #only the valid transaction must update the index
+    expected = [('100', 'valid public key')]
+    if writes != expected:
+        print("Unexpected meter writes:", writes, "expected:", expected)
+        exit(1)
+
+    #so far, so good
+    print("The block parser returned the expected meters:", writes)
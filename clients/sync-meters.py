@@ -0,0 +1,288 @@
+"""
+    The BlockMeter Experiment
+    ~~~~~~~~~
+    This module keeps a local replica of the meter registry (meter ID and
+    public key). The replica is a SQLite file indexed by the meter ID, so bulk
+    lookups, exports and offline signature verification can run without
+    querying the peers.
+    On the first run, the replica is built from a snapshot of the world state,
+    read page by page with the chaincode queryLedger. After that, it is updated incrementally by reading
+    the committed blocks and applying their registerMeter writes. The number of
+    the last applied block is saved together with the meters, so the module
+    resumes from that point after a restart.
+    A plain run applies the blocks committed since the last run and stops. In
+    the follow mode, the module listens to the channel event hub and applies
+    each new block as soon as it is committed.
+
+    :copyright: © 2020 by Wilson Melo Jr.
+"""
+
+import sys
+import json
+import time
+import sqlite3
+import grpc
+from hfc.fabric import Client as client_fabric
+from hfc.protos.peer import chaincode_pb2
+import asyncio
+
+#number of meters read by each snapshot query. Small pages keep us far from the
+#peer total query limit and from the gRPC message size limit
+SNAPSHOT_PAGE_SIZE = 1000
+
+#number of blocks without meter writes applied before the checkpoint is saved
+CHECKPOINT_INTERVAL = 100
+
+#seconds to wait before reconnecting to the peer in the follow mode
+RETRY_DELAY = 5
+
+#Fabric constants used to filter the block contents
+ENDORSER_TRANSACTION = 3
+TX_VALID = 0
+
+
+def open_index(index_file):
+    """Opens (or creates) the local meter index and returns the connection."""
+    db = sqlite3.connect(index_file)
+    db.execute("CREATE TABLE IF NOT EXISTS meter ("
+               "id TEXT PRIMARY KEY, pubkey TEXT NOT NULL) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS checkpoint ("
+               "id INTEGER PRIMARY KEY CHECK (id = 0), last_block INTEGER NOT NULL)")
+    db.commit()
+    return db
+
+
+def get_last_block(db):
+    """Returns the number of the last block applied to the index, or None."""
+    row = db.execute("SELECT last_block FROM checkpoint WHERE id = 0").fetchone()
+    return row[0] if row else None
+
+
+def save_meters(db, writes, last_block):
+    """Applies a list of (meter id, public key) writes and moves the checkpoint
+    in the same SQLite transaction. A None public key removes the meter, and a
+    None last_block keeps the checkpoint as it is."""
+    with db:
+        for meter_id, pub_key in writes:
+            if pub_key is None:
+                db.execute("DELETE FROM meter WHERE id = ?", (meter_id,))
+            else:
+                db.execute("INSERT OR REPLACE INTO meter (id, pubkey) VALUES (?, ?)",
+                           (meter_id, pub_key))
+        if last_block is not None:
+            db.execute("INSERT OR REPLACE INTO checkpoint (id, last_block) VALUES (0, ?)",
+                       (last_block,))
+
+
+def snapshot_query(last_key):
+    """Builds the CouchDB query that reads the snapshot page following the meter
+    ID last_key. Sorting by _id (the meter ID) makes the pages contiguous."""
+    return json.dumps({
+        "selector": {"_id": {"$gt": last_key}, "pubkey": {"$exists": True}},
+        "sort": [{"_id": "asc"}],
+        "limit": SNAPSHOT_PAGE_SIZE})
+
+
+def get_meter_writes(block):
+    """Extracts the (meter id, public key) pairs written by valid registerMeter
+    transactions of a decoded block."""
+    writes = []
+
+    #the transactions filter keeps the validation code of each transaction
+    metadata = block['metadata']['metadata']
+    tx_filter = metadata[2] if len(metadata) > 2 else None
+
+    for i, envelope in enumerate(block['data']['data']):
+        #skip invalid transactions, they did not change the world state
+        if tx_filter and tx_filter[i] != TX_VALID:
+            continue
+
+        #skip config blocks and other non-endorser transactions
+        payload = envelope['payload']
+        if payload['header']['channel_header']['type'] != ENDORSER_TRANSACTION:
+            continue
+
+        for action in payload['data']['actions']:
+            #only registerMeter changes the meter public keys. The SDK keeps the
+            #proposal input encoded, so we parse it to read the function name
+            spec = chaincode_pb2.ChaincodeInvocationSpec()
+            spec.ParseFromString(action['payload']['chaincode_proposal_payload']['input'])
+            args = spec.chaincode_spec.input.args
+            if not args or args[0] != b'registerMeter':
+                continue
+
+            results = action['payload']['action']['proposal_response_payload']['extension']['results']
+            for ns_rwset in results['ns_rwset']:
+                if ns_rwset['namespace'] != 'fabpki':
+                    continue
+                for kv_write in ns_rwset['rwset']['writes']:
+                    if kv_write['is_delete']:
+                        writes.append((kv_write['key'], None))
+                    else:
+                        value = kv_write['value']
+                        if isinstance(value, bytes):
+                            value = value.decode('utf-8')
+                        writes.append((kv_write['key'], json.loads(value)['pubkey']))
+
+    return writes
+
+
+def apply_block(block):
+    """Applies the meter writes of a decoded block to the index opened in db and
+    moves last_block to that block. A block with writes is saved at once,
+    together with its checkpoint. The blocks without writes only move the
+    saved checkpoint (saved_block) every CHECKPOINT_INTERVAL blocks."""
+    global last_block, saved_block
+
+    #the blocks already in the index are ignored
+    number = block['header']['number']
+    if number <= last_block:
+        return
+
+    writes = get_meter_writes(block)
+    if writes or number - saved_block >= CHECKPOINT_INTERVAL:
+        save_meters(db, writes, number)
+        saved_block = number
+    last_block = number
+
+    if writes:
+        print("Block", number, "updated", len(writes), "meters")
+
+
+def save_checkpoint():
+    """Saves the checkpoint of the blocks applied since the last save."""
+    global saved_block
+
+    if last_block != saved_block:
+        save_meters(db, [], last_block)
+        saved_block = last_block
+
+
+if __name__ == "__main__":
+
+    #test if the index file was informed as argument
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != "follow"):
+        print("Usage:",sys.argv[0],"<index file> [follow]")
+        exit(1)
+
+    #get the index file and, if informed, keep following new blocks
+    index_file = sys.argv[1]
+    follow = len(sys.argv) == 3
+
+    #open the local replica and check where we stopped last time
+    db = open_index(index_file)
+    last_block = get_last_block(db)
+
+    #creates a loop object to manage async transactions
+    loop = asyncio.get_event_loop()
+
+    #instantiate the hyperledeger fabric client
+    c_hlf = client_fabric(net_profile="ptb-network-tls.json")
+
+    #get access to Fabric as Admin user
+    admin = c_hlf.get_user('ptb.de', 'Admin')
+
+    #the Fabric Python SDK do not read the channel configuration, we need to add it mannually
+    channel = c_hlf.new_channel('ptb-channel')
+
+    #a new index starts from a snapshot of the world state
+    if last_block is None:
+        #read the height before the query, so the blocks committed during the
+        #snapshot are replayed later (registerMeter writes can be safely reapplied)
+        info = loop.run_until_complete(c_hlf.query_info(
+            requestor=admin,
+            channel_name='ptb-channel',
+            peers=['peer0.ptb.de'],
+            decode=True))
+        snapshot_block = info.height - 1
+
+        print("Building the index from a snapshot at block", snapshot_block)
+        last_key = ""
+        total = 0
+        while True:
+            response = loop.run_until_complete(c_hlf.chaincode_query(
+                requestor=admin,
+                channel_name='ptb-channel',
+                peers=['peer0.ptb.de'],
+                cc_name='fabpki',
+                cc_version='1.0',
+                fcn='queryLedger',
+                args=[snapshot_query(last_key)]))
+
+            #on failure, the SDK returns the peer error message instead of the records
+            try:
+                records = json.loads(response)
+            except ValueError:
+                print("The snapshot query failed:", response)
+                exit(1)
+
+            #the pages are saved without checkpoint, so an interrupted snapshot restarts
+            save_meters(db, [(r['Key'], r['Record']['pubkey']) for r in records], None)
+            total += len(records)
+            print("Snapshot has", total, "meters so far...")
+
+            #a short page means there are no more meters to read
+            if len(records) < SNAPSHOT_PAGE_SIZE:
+                break
+            last_key = records[-1]['Key']
+
+        #only now the snapshot is complete and the checkpoint can be saved
+        save_meters(db, [], snapshot_block)
+        last_block = snapshot_block
+        print("Snapshot saved with", total, "meters")
+
+    #the last checkpoint saved in the index
+    saved_block = last_block
+
+    #check how many blocks the peer has committed so far
+    info = loop.run_until_complete(c_hlf.query_info(
+        requestor=admin,
+        channel_name='ptb-channel',
+        peers=['peer0.ptb.de'],
+        decode=True))
+
+    #a checkpoint beyond the channel height means the channel was recreated (e.g.,
+    #by resetRestart.sh), so the index does not match this ledger anymore
+    if last_block >= info.height:
+        print("The index", index_file, "is at block", last_block, "but the channel has only",
+              info.height, "blocks. Remove the index file to build it again.")
+        db.close()
+        exit(1)
+
+    try:
+        if not follow:
+            #apply the blocks committed since the checkpoint, one block at a time
+            for number in range(last_block + 1, info.height):
+                apply_block(loop.run_until_complete(c_hlf.query_block(
+                    requestor=admin,
+                    channel_name='ptb-channel',
+                    peers=['peer0.ptb.de'],
+                    block_number=str(number),
+                    decode=True)))
+            save_checkpoint()
+        else:
+            while True:
+                #the event hub delivers the full blocks (not filtered ones, they have no
+                #write sets) starting right after the checkpoint, and then each new block
+                event_hub = channel.newChannelEventHub(c_hlf.get_peer('peer0.ptb.de'), admin)
+                event_hub.registerBlockEvent(unregister=False, onEvent=apply_block)
+                print("Following the blocks from block", last_block + 1)
+                try:
+                    loop.run_until_complete(event_hub.connect(filtered=False, start=last_block + 1))
+                    print("The peer closed the block stream")
+                except grpc.RpcError as e:
+                    #a peer restart or a network failure must not stop the follower
+                    print("Lost the connection with the peer:", e)
+
+                #save where we stopped and reconnect from there
+                save_checkpoint()
+                time.sleep(RETRY_DELAY)
+    except KeyboardInterrupt:
+        #the meter writes are already saved, only the checkpoint may be behind
+        print("Stopped by the user")
+        save_checkpoint()
+
+    #so far, so good
+    count = db.execute("SELECT COUNT(*) FROM meter").fetchone()[0]
+    print("The index", index_file, "has", count, "meters up to block", last_block)
+    db.close()